@@ -16,15 +16,14 @@ import contextlib
 import functools
 import logging
 import sys
-from typing import TYPE_CHECKING, Any, Callable, Sequence
-from urllib.parse import urlsplit
+from typing import TYPE_CHECKING, Any, Callable, Iterable, Sequence
 
 from mkdocs.config.base import Config
 from mkdocs.config.config_options import Type
 from mkdocs.plugins import BasePlugin
 from mkdocs.structure.pages import Page
 
-from mkdocs_autorefs.references import AutorefsExtension, fix_refs, relative_url
+from mkdocs_autorefs.references import AutorefsExtension, _is_external, fix_refs, relative_url
 
 if TYPE_CHECKING:
     from mkdocs.config.defaults import MkDocsConfig
@@ -55,6 +54,11 @@ else:
     from pathlib import PurePosixPath as URL  # noqa: N814
 
 
+@functools.lru_cache(maxsize=4096)
+def _url_path(url: str) -> URL:
+    return URL(url)
+
+
 class AutorefsConfig(Config):
     """Configuration options for the `autorefs` plugin."""
 
@@ -105,6 +109,7 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
             page: The relative URL of the current page. Examples: `'foo/bar/'`, `'foo/index.html'`
             identifier: The HTML anchor (without '#') as a string.
         """
+        identifier = sys.intern(str(identifier))
         page_anchor = f"{page}#{anchor or identifier}"
         if identifier in self._url_map:
             if page_anchor not in self._url_map[identifier]:
@@ -112,6 +117,23 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
         else:
             self._url_map[identifier] = [page_anchor]
 
+    def register_anchors(self, page: str, identifiers: Iterable[str], anchor: str | None = None) -> None:
+        """Register that anchors corresponding to identifiers were encountered when rendering the page.
+
+        Arguments:
+            page: The relative URL of the current page. Examples: `'foo/bar/'`, `'foo/index.html'`
+            identifiers: The HTML anchors (without '#') as strings.
+            anchor: An optional anchor (without '#') that all identifiers should point to.
+        """
+        url_map = self._url_map
+        alias_anchor = f"{page}#{anchor}" if anchor else None
+        for identifier in map(sys.intern, map(str, identifiers)):
+            page_anchor = alias_anchor or f"{page}#{identifier}"
+            if (urls := url_map.get(identifier)) is None:
+                url_map[identifier] = [page_anchor]
+            elif page_anchor not in urls:
+                urls.append(page_anchor)
+
     def register_url(self, identifier: str, url: str) -> None:
         """Register that the identifier should be turned into a link to this URL.
 
@@ -119,7 +141,7 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
             identifier: The new identifier.
             url: The absolute URL (including anchor, if needed) where this item can be found.
         """
-        self._abs_url_map[identifier] = url
+        self._abs_url_map[sys.intern(str(identifier))] = url
 
     @staticmethod
     def _get_closest_url(from_url: str, urls: list[str]) -> str:
@@ -133,9 +155,11 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
             The closest URL to the current page.
         """
         base_url = URL(from_url)
+        # Candidate URLs are the same across pages: reuse their parsed paths.
+        paths = [(url, _url_path(url)) for url in urls]
 
         while True:
-            if candidates := [url for url in urls if URL(url).is_relative_to(base_url)]:
+            if candidates := [url for url, path in paths if path.is_relative_to(base_url)]:
                 break
             base_url = base_url.parent
             if not base_url.name:
@@ -168,6 +192,9 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
             if fallback:
                 new_identifiers = fallback(identifier)
                 for new_identifier in new_identifiers:
+                    if new_identifier == identifier:
+                        # We already know this one is not registered.
+                        continue
                     with contextlib.suppress(KeyError):
                         url = self._get_item_url(new_identifier)
                         self._url_map[identifier] = [url]
@@ -202,12 +229,20 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
             A site-relative URL.
         """
         url = self._get_item_url(identifier, fallback, from_url)
-        if from_url is not None:
-            parsed = urlsplit(url)
-            if not parsed.scheme and not parsed.netloc:
-                return relative_url(from_url, url)
+        if from_url is not None and not _is_external(url):
+            return relative_url(from_url, url)
         return url
 
+    def _get_url_mapper(self, from_url: str) -> Callable[[str], str]:
+        # A plain closure with positional arguments is cheaper to call than a `functools.partial` with keywords.
+        get_item_url = self.get_item_url
+        fallback = self.get_fallback_anchor
+
+        def url_mapper(identifier: str) -> str:
+            return get_item_url(identifier, from_url, fallback)
+
+        return url_mapper
+
     def on_config(self, config: MkDocsConfig) -> MkDocsConfig | None:
         """Instantiate our Markdown extension.
 
@@ -285,7 +320,7 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
 
         We log a warning for each reference that we couldn't map to an URL, but try to be smart and ignore identifiers
         that do not look legitimate (sometimes documentation can contain strings matching
-        our [`AUTO_REF_RE`][mkdocs_autorefs.references.AUTO_REF_RE] regular expression that did not intend to reference anything).
+        our [`AUTOREF_RE`][mkdocs_autorefs.references.AUTOREF_RE] regular expression that did not intend to reference anything).
         We currently ignore references when their identifier contains a space or a slash.
 
         Arguments:
@@ -298,7 +333,7 @@ class AutorefsPlugin(BasePlugin[AutorefsConfig]):
         """
         log.debug("Fixing references in page %s", page.file.src_path)
 
-        url_mapper = functools.partial(self.get_item_url, from_url=page.url, fallback=self.get_fallback_anchor)
+        url_mapper = self._get_url_mapper(page.url)
         fixed_output, unmapped = fix_refs(output, url_mapper, _legacy_refs=self.legacy_refs)
 
         if unmapped and log.isEnabledFor(logging.WARNING):
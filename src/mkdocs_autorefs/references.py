@@ -1,4 +1,7 @@
-"""Cross-references module."""
+"""Cross-references module.
+
+The `AUTO_REF_RE` attribute is deprecated: use [`AUTOREF_RE`][mkdocs_autorefs.references.AUTOREF_RE] instead.
+"""
 
 from __future__ import annotations
 
@@ -9,17 +12,14 @@ from abc import ABC, abstractmethod
 from dataclasses import dataclass
 from functools import lru_cache
 from html import escape, unescape
-from html.parser import HTMLParser
-from typing import TYPE_CHECKING, Any, Callable, ClassVar, Match
-from urllib.parse import urlsplit
+from typing import TYPE_CHECKING, Any, Callable, ClassVar, Iterable, Iterator, Match, Pattern
 from xml.etree.ElementTree import Element
 
-import markupsafe
 from markdown.core import Markdown
 from markdown.extensions import Extension
 from markdown.inlinepatterns import REFERENCE_RE, ReferenceInlineProcessor
 from markdown.treeprocessors import Treeprocessor
-from markdown.util import HTML_PLACEHOLDER_RE, INLINE_PLACEHOLDER_RE
+from markdown.util import HTML_PLACEHOLDER_RE, INLINE_PLACEHOLDER_RE, STX
 
 if TYPE_CHECKING:
     from pathlib import Path
@@ -42,20 +42,27 @@ def __getattr__(name: str) -> Any:
     if name == "AutoRefInlineProcessor":
         warnings.warn("AutoRefInlineProcessor was renamed AutorefsInlineProcessor", DeprecationWarning, stacklevel=2)
         return AutorefsInlineProcessor
+    if name == "AUTO_REF_RE":
+        # Deprecated, use `AUTOREF_RE` instead. Compiled on first access.
+        return _legacy_autoref_re()
     raise AttributeError(f"module 'mkdocs_autorefs.references' has no attribute {name}")
 
 
 _ATTR_VALUE = r'"[^"<>]+"|[^"<> ]+'  # Possibly with double quotes around
 
+
 # YORE: Bump 2: Remove block.
-AUTO_REF_RE = re.compile(
-    rf"<span data-(?P<kind>autorefs-(?:identifier|optional|optional-hover))=(?P<identifier>{_ATTR_VALUE})"
-    rf"(?: class=(?P<class>{_ATTR_VALUE}))?(?P<attrs> [^<>]+)?>(?P<title>.*?)</span>",
-    flags=re.DOTALL,
-)
-"""Deprecated. Use [`AUTOREF_RE`][mkdocs_autorefs.references.AUTOREF_RE] instead."""
+@lru_cache(maxsize=None)
+def _legacy_autoref_re() -> Pattern[str]:
+    # Compiled on first use only, when legacy references are actually found.
+    return re.compile(
+        rf"<span data-(?P<kind>autorefs-(?:identifier|optional|optional-hover))=(?P<identifier>{_ATTR_VALUE})"
+        rf"(?: class=(?P<class>{_ATTR_VALUE}))?(?P<attrs> [^<>]+)?>(?P<title>.*?)</span>",
+        flags=re.DOTALL,
+    )
 
-AUTOREF_RE = re.compile(r"<autoref (?P<attrs>.*?)>(?P<title>.*?)</autoref>", flags=re.DOTALL)
+
+AUTOREF_RE = re.compile(r"<autoref (?P<attrs>[^>]*)>(?P<title>.*?)</autoref>", flags=re.DOTALL)
 """The autoref HTML tag regular expression.
 
 A regular expression to match mkdocs-autorefs' special reference markers
@@ -63,6 +70,16 @@ in the [`on_post_page` hook][mkdocs_autorefs.plugin.AutorefsPlugin.on_post_page]
 """
 
 
+_CONTROL_CHARS_RE = re.compile(r"[\x00-\x1f]")
+_STRIP_TAGS_RE = re.compile(r"<!--.*?-->|<[^>]*>", flags=re.DOTALL)
+
+
+def _strip_tags(html: str) -> str:
+    # Same as `markupsafe.Markup(html).striptags()`: remove comments and tags,
+    # normalize whitespace, then unescape HTML entities.
+    return unescape(" ".join(_STRIP_TAGS_RE.sub("", html).split()))
+
+
 class AutorefsHookInterface(ABC):
     """An interface for hooking into how AutoRef handles inline references."""
 
@@ -138,7 +155,7 @@ class AutorefsInlineProcessor(ReferenceInlineProcessor):
         if not handled or identifier is None:
             return None, None, None
 
-        if re.search(r"[\x00-\x1f]", identifier):
+        if _CONTROL_CHARS_RE.search(identifier):
             # Do nothing if the matched reference contains control characters (from 0 to 31 included).
             # Specifically `\x01` is used by Python-Markdown HTML stash when there's inline formatting,
             # but references with Markdown formatting are not possible anyway.
@@ -169,23 +186,24 @@ class AutorefsInlineProcessor(ReferenceInlineProcessor):
             # Allow the entire content to be one placeholder, with the intent of catching things like [`Foo`][].
             # It doesn't catch [*Foo*][] though, just due to the priority order.
             # https://github.com/Python-Markdown/markdown/blob/1858c1b601ead62ed49646ae0d99298f41b1a271/markdown/inlinepatterns.py#L78
-            if match := INLINE_PLACEHOLDER_RE.fullmatch(identifier):
+            # Both placeholders start with STX: check it before trying to match them.
+            if identifier.startswith(STX) and (match := INLINE_PLACEHOLDER_RE.fullmatch(identifier)):
                 stashed_nodes: dict[str, Element | str] = self.md.treeprocessors["inline"].stashed_nodes  # type: ignore[attr-defined]
                 el = stashed_nodes.get(match[1])
                 if isinstance(el, Element) and el.tag == "code":
                     identifier = "".join(el.itertext())
                     # Special case: allow pymdownx.inlinehilite raw <code> snippets but strip them back to unhighlighted.
-                    if match := HTML_PLACEHOLDER_RE.fullmatch(identifier):
+                    if identifier.startswith(STX) and (match := HTML_PLACEHOLDER_RE.fullmatch(identifier)):
                         stash_index = int(match.group(1))
                         html = self.md.htmlStash.rawHtmlBlocks[stash_index]
-                        identifier = markupsafe.Markup(html).striptags()
+                        identifier = _strip_tags(html)
                         self.md.htmlStash.rawHtmlBlocks[stash_index] = escape(identifier)
 
         end = m.end(0)
         return identifier, end, True
 
     def _make_tag(self, identifier: str, text: str) -> Element:
-        """Create a tag that can be matched by `AUTO_REF_RE`.
+        """Create a tag that can be matched by `AUTOREF_RE`.
 
         Arguments:
             identifier: The identifier to use in the HTML property.
@@ -194,11 +212,13 @@ class AutorefsInlineProcessor(ReferenceInlineProcessor):
         Returns:
             A new element.
         """
-        el = Element("autoref")
         if self.hook:
             identifier = self.hook.expand_identifier(identifier)
-            el.attrib.update(self.hook.get_context().as_dict())
-        el.set("identifier", identifier)
+            attrib = self.hook.get_context().as_dict()
+            attrib["identifier"] = identifier
+        else:
+            attrib = {"identifier": identifier}
+        el = Element("autoref", attrib)
         el.text = text
         return el
 
@@ -213,22 +233,51 @@ def relative_url(url_a: str, url_b: str) -> str:
     Returns:
         The relative URL to go from A to B.
     """
-    parts_a = url_a.split("/")
     url_b, anchor = url_b.split("#", 1)
+
+    # same page, or linking from the site root: nothing to compute
+    if url_a == url_b:
+        return f"#{anchor}"
+    if not url_a and not url_b.startswith("/"):
+        return f"{url_b}#{anchor}"
+
+    parts_a = url_a.split("/")
     parts_b = url_b.split("/")
 
-    # remove common left parts
-    while parts_a and parts_b and parts_a[0] == parts_b[0]:
-        parts_a.pop(0)
-        parts_b.pop(0)
+    # count common left parts
+    common = 0
+    for part_a, part_b in zip(parts_a, parts_b):
+        if part_a != part_b:
+            break
+        common += 1
 
     # go up as many times as remaining a parts' depth
-    levels = len(parts_a) - 1
-    parts_relative = [".."] * levels + parts_b
-    relative = "/".join(parts_relative)
+    levels = len(parts_a) - common - 1
+    relative = "/".join([".."] * levels + parts_b[common:])
     return f"{relative}#{anchor}"
 
 
+_IDENTIFIER_ONLY_RE = re.compile(r'identifier="([^"&]*)"')
+# Like checking `urlsplit(url).scheme or urlsplit(url).netloc`, without parsing the whole URL.
+# Leading control characters and spaces are skipped as `urlsplit` strips them, but tabs and
+# newlines *inside* the URL are not removed first, so a URL like "ht\ttp://x" is considered internal.
+_EXTERNAL_URL_RE = re.compile(r"[\x00-\x20]*(?:[a-zA-Z][a-zA-Z0-9+.-]*:|//[^/?#])")
+_CLASS_INTERNAL = "autorefs autorefs-internal"
+_CLASS_EXTERNAL = "autorefs autorefs-external"
+
+
+def _is_external(url: str) -> bool:
+    # Equivalent to checking the `scheme` and `netloc` of `urlsplit(url)`, without building the split result.
+    return _EXTERNAL_URL_RE.match(url) is not None
+
+
+@lru_cache(maxsize=4096)
+def _escape_url(url: str) -> str:
+    # URLs are constant for a given identifier, and the same identifiers
+    # are referenced many times across pages: cache their escaped version.
+    return escape(url)
+
+
 # YORE: Bump 2: Remove block.
 def _legacy_fix_ref(
     url_mapper: Callable[[str], str],
@@ -257,10 +306,9 @@ def _legacy_fix_ref(
         title = match["title"]
         kind = match["kind"]
         attrs = match["attrs"] or ""
-        classes = (match["class"] or "").strip('"').split()
 
         try:
-            url = url_mapper(unescape(identifier))
+            url = url_mapper(unescape(identifier) if "&" in identifier else identifier)
         except KeyError:
             if kind == "autorefs-optional":
                 return title
@@ -277,19 +325,18 @@ def _legacy_fix_ref(
             DeprecationWarning,
             stacklevel=1,
         )
-        parsed = urlsplit(url)
-        external = parsed.scheme or parsed.netloc
-        classes = ["autorefs", "autorefs-external" if external else "autorefs-internal", *classes]
-        class_attr = " ".join(classes)
+        class_attr = _CLASS_EXTERNAL if _is_external(url) else _CLASS_INTERNAL
+        if classes := match["class"]:
+            class_attr = " ".join([class_attr, *classes.strip('"').split()])
         if kind == "autorefs-optional-hover":
-            return f'<a class="{class_attr}" title="{identifier}" href="{escape(url)}"{attrs}>{title}</a>'
-        return f'<a class="{class_attr}" href="{escape(url)}"{attrs}>{title}</a>'
+            return f'<a class="{class_attr}" title="{identifier}" href="{_escape_url(url)}"{attrs}>{title}</a>'
+        return f'<a class="{class_attr}" href="{_escape_url(url)}"{attrs}>{title}</a>'
 
     return inner
 
 
-class _AutorefsAttrs(dict):
-    _handled_attrs: ClassVar[set[str]] = {
+_HANDLED_ATTRS = frozenset(
+    (
         "identifier",
         "optional",
         "hover",
@@ -299,41 +346,88 @@ class _AutorefsAttrs(dict):
         "origin",
         "filepath",
         "lineno",
-    }
+    ),
+)
+
+
+class _AutorefsAttrs:
+    __slots__ = (
+        "class_",
+        "domain",
+        "extras",
+        "filepath",
+        "hover",
+        "identifier",
+        "lineno",
+        "optional",
+        "origin",
+        "role",
+    )
+
+    def __init__(self, attrs: Iterable[tuple[str, str | None]]) -> None:
+        self.identifier: str = ""
+        self.optional: bool = False
+        self.hover: bool = False
+        self.class_: str | None = None
+        self.domain: str | None = None
+        self.role: str | None = None
+        self.origin: str | None = None
+        self.filepath: str | None = None
+        self.lineno: str | None = None
+        # Attributes we don't handle, to pass them through to the final link.
+        self.extras: dict[str, str | None] = {}
+        handled = _HANDLED_ATTRS
+        for name, value in attrs:
+            if name not in handled:
+                self.extras[name] = value
+            elif name == "optional":
+                self.optional = True
+            elif name == "hover":
+                self.hover = True
+            elif name == "class":
+                self.class_ = value
+            else:
+                setattr(self, name, value)
 
     @property
     def context(self) -> AutorefsHookInterface.Context | None:
-        try:
-            return AutorefsHookInterface.Context(
-                domain=self["domain"],
-                role=self["role"],
-                origin=self["origin"],
-                filepath=self["filepath"],
-                lineno=int(self["lineno"]),
-            )
-        except KeyError:
+        if (
+            self.domain is None
+            or self.role is None
+            or self.origin is None
+            or self.filepath is None
+            or self.lineno is None
+        ):
             return None
+        return AutorefsHookInterface.Context(
+            domain=self.domain,
+            role=self.role,
+            origin=self.origin,
+            filepath=self.filepath,
+            lineno=int(self.lineno),
+        )
 
     @property
     def remaining(self) -> str:
-        return " ".join(k if v is None else f'{k}="{v}"' for k, v in self.items() if k not in self._handled_attrs)
+        if not self.extras:
+            return ""
+        return " ".join(k if v is None else f'{k}="{v}"' for k, v in self.extras.items())
 
 
-class _HTMLAttrsParser(HTMLParser):
-    def __init__(self):
-        super().__init__()
-        self.attrs = {}
+_ATTR_RE = re.compile(r"""([^\s"'>/=]+)(?:\s*=\s*("[^"]*"|'[^']*'|[^\s>]+))?""")
 
-    def parse(self, html: str) -> _AutorefsAttrs:
-        self.attrs.clear()
-        self.feed(html)
-        return _AutorefsAttrs(self.attrs)
 
-    def handle_starttag(self, tag: str, attrs: list[tuple[str, str | None]]) -> None:  # noqa: ARG002
-        self.attrs.update(attrs)
+def _attr_value(value: str) -> str | None:
+    if not value:
+        # Attribute without value, like `optional`.
+        return None
+    if value[0] in "\"'":
+        value = value[1:-1]
+    return unescape(value) if "&" in value else value
 
 
-_html_attrs_parser = _HTMLAttrsParser()
+def _parse_attrs(html: str) -> _AutorefsAttrs:
+    return _AutorefsAttrs((name.lower(), _attr_value(value)) for name, value in _ATTR_RE.findall(html))
 
 
 def fix_ref(
@@ -360,33 +454,60 @@ def fix_ref(
 
     def inner(match: Match) -> str:
         title = match["title"]
-        attrs = _html_attrs_parser.parse(f"<a {match['attrs']}>")
-        identifier: str = attrs["identifier"]
-        optional = "optional" in attrs
-        hover = "hover" in attrs
+        if simple := _IDENTIFIER_ONLY_RE.fullmatch(match["attrs"]):
+            # Fast path for the most common case: a lone identifier without HTML entities,
+            # as generated by our Markdown extension when no hook is set.
+            attrs = _AutorefsAttrs((("identifier", simple[1]),))
+        else:
+            attrs = _parse_attrs(match["attrs"])
+        identifier = attrs.identifier
+        optional = attrs.optional
+        hover = attrs.hover
 
         try:
-            url = url_mapper(unescape(identifier))
+            url = url_mapper(unescape(identifier) if "&" in identifier else identifier)
         except KeyError:
             if optional:
                 if hover:
-                    return f'<span title="{identifier}">{title}</span>'
+                    return f'<span title="{escape(identifier)}">{title}</span>'
                 return title
             unmapped.append((identifier, attrs.context))
-            if title == identifier:
-                return f"[{identifier}][]"
-            return f"[{title}][{identifier}]"
-
-        parsed = urlsplit(url)
-        external = parsed.scheme or parsed.netloc
-        classes = (attrs.get("class") or "").strip().split()
-        classes = ["autorefs", "autorefs-external" if external else "autorefs-internal", *classes]
-        class_attr = " ".join(classes)
+            # The identifier was unescaped when parsing attributes: escape it back, once.
+            escaped_identifier = escape(identifier, quote=False)
+            if title == escaped_identifier:
+                return f"[{escaped_identifier}][]"
+            return f"[{title}][{escaped_identifier}]"
+
+        class_attr = _CLASS_EXTERNAL if _is_external(url) else _CLASS_INTERNAL
+        if classes := attrs.class_:
+            class_attr = " ".join([class_attr, *classes.split()])
         if remaining := attrs.remaining:
             remaining = f" {remaining}"
         if optional and hover:
-            return f'<a class="{class_attr}" title="{identifier}" href="{escape(url)}"{remaining}>{title}</a>'
-        return f'<a class="{class_attr}" href="{escape(url)}"{remaining}>{title}</a>'
+            # Same as above, but in an attribute value: quotes must be escaped too.
+            return (
+                f'<a class="{class_attr}" title="{escape(identifier)}" href="{_escape_url(url)}"{remaining}>{title}</a>'
+            )
+        return f'<a class="{class_attr}" href="{_escape_url(url)}"{remaining}>{title}</a>'
+
+    return inner
+
+
+def _cache_url_mapper(url_mapper: Callable[[str], str]) -> Callable[[str], str]:
+    cache: dict[str, str | None] = {}
+
+    def inner(identifier: str) -> str:
+        try:
+            url = cache[identifier]
+        except KeyError:
+            try:
+                url = url_mapper(identifier)
+            except KeyError:
+                url = None
+            cache[identifier] = url
+        if url is None:
+            raise KeyError(identifier)
+        return url
 
     return inner
 
@@ -400,6 +521,9 @@ def fix_refs(
 ) -> tuple[str, list[tuple[str, AutorefsHookInterface.Context | None]]]:
     """Fix all references in the given HTML text.
 
+    The URL mapper is called at most once per identifier:
+    its results (and failures) are cached for the duration of the call.
+
     Arguments:
         html: The text to fix.
         url_mapper: A callable that gets an object's site URL by its identifier,
@@ -409,11 +533,15 @@ def fix_refs(
         The fixed HTML, and a list of unmapped identifiers (string and optional context).
     """
     unmapped: list[tuple[str, AutorefsHookInterface.Context | None]] = []
-    html = AUTOREF_RE.sub(fix_ref(url_mapper, unmapped), html)
+    url_mapper = _cache_url_mapper(url_mapper)
+
+    # Many pages don't contain any reference: don't scan them with regular expressions.
+    if "<autoref " in html:
+        html = AUTOREF_RE.sub(fix_ref(url_mapper, unmapped), html)
 
     # YORE: Bump 2: Remove block.
-    if _legacy_refs:
-        html = AUTO_REF_RE.sub(_legacy_fix_ref(url_mapper, unmapped), html)
+    if _legacy_refs and "<span data-autorefs-" in html:
+        html = _legacy_autoref_re().sub(_legacy_fix_ref(url_mapper, unmapped), html)
 
     return html, unmapped
 
@@ -428,45 +556,61 @@ class AnchorScannerTreeProcessor(Treeprocessor):
         """Initialize the tree processor.
 
         Parameters:
-            plugin: A reference to the autorefs plugin, to use its `register_anchor` method.
+            plugin: A reference to the autorefs plugin, to use its `register_anchors` method.
         """
         super().__init__(md)
         self.plugin = plugin
 
     def run(self, root: Element) -> None:  # noqa: D102
         if self.plugin.current_page is not None:
-            pending_anchors = _PendingAnchors(self.plugin, self.plugin.current_page)
-            self._scan_anchors(root, pending_anchors)
-            pending_anchors.flush()
-
-    def _scan_anchors(self, parent: Element, pending_anchors: _PendingAnchors) -> None:
-        for el in parent:
-            if el.tag == "a":
-                # We found an anchor. Record its id if it has one.
-                if anchor_id := el.get("id"):
-                    pending_anchors.append(anchor_id)
-                # If the element has text or a link, it's not an alias.
-                # Non-whitespace text after the element interrupts the chain, aliases can't apply.
-                if el.text or el.get("href") or (el.tail and el.tail.strip()):
-                    pending_anchors.flush()
-
-            elif el.tag == "p":
-                # A `p` tag is a no-op for our purposes, just recurse into it in the context
-                # of the current collection of anchors.
-                self._scan_anchors(el, pending_anchors)
-                # Non-whitespace text after the element interrupts the chain, aliases can't apply.
-                if el.tail and el.tail.strip():
+            self._scan_anchors(root, _PendingAnchors(self.plugin, self.plugin.current_page))
+
+    def _scan_anchors(self, root: Element, pending_anchors: _PendingAnchors) -> None:
+        htags = self._htags
+        # We use an explicit stack rather than recursion. Each item holds an iterator
+        # on the children of an element, the pending anchors of its context,
+        # and the element itself when it's a `p` tag sharing the context of its parent.
+        stack: list[tuple[Iterator[Element], _PendingAnchors, Element | None]] = [(iter(root), pending_anchors, None)]
+        while stack:
+            children, pending_anchors, paragraph = stack[-1]
+            for el in children:
+                tag = el.tag
+                if tag == "a":
+                    attrib = el.attrib
+                    # We found an anchor. Record its id if it has one.
+                    if anchor_id := attrib.get("id"):
+                        pending_anchors.append(anchor_id)
+                    # If the element has text or a link, it's not an alias.
+                    # Non-whitespace text after the element interrupts the chain, aliases can't apply.
+                    if el.text or attrib.get("href") or (el.tail and el.tail.strip()):
+                        pending_anchors.flush()
+
+                elif tag == "p":
+                    # A `p` tag is a no-op for our purposes, just scan it in the context
+                    # of the current collection of anchors.
+                    stack.append((iter(el), pending_anchors, el))
+                    break
+
+                elif tag in htags:
+                    # If the element is a heading, that turns the pending anchors into aliases.
+                    pending_anchors.flush(el.attrib.get("id"))
+
+                else:
+                    # But if it's some other interruption, flush anchors anyway as non-aliases.
                     pending_anchors.flush()
-
-            elif el.tag in self._htags:
-                # If the element is a heading, that turns the pending anchors into aliases.
-                pending_anchors.flush(el.get("id"))
+                    # Scan sub-elements, in a *separate* context.
+                    stack.append((iter(el), _PendingAnchors(self.plugin, pending_anchors.current_page), None))
+                    break
 
             else:
-                # But if it's some other interruption, flush anchors anyway as non-aliases.
-                pending_anchors.flush()
-                # Recurse into sub-elements, in a *separate* context.
-                self.run(el)
+                # All children were scanned.
+                stack.pop()
+                if paragraph is None:
+                    # End of a separate context, remaining anchors can't be aliases.
+                    pending_anchors.flush()
+                elif paragraph.tail and paragraph.tail.strip():
+                    # Non-whitespace text after the element interrupts the chain, aliases can't apply.
+                    pending_anchors.flush()
 
 
 class _PendingAnchors:
@@ -481,9 +625,9 @@ class _PendingAnchors:
         self.anchors.append(anchor)
 
     def flush(self, alias_to: str | None = None) -> None:
-        for anchor in self.anchors:
-            self.plugin.register_anchor(self.current_page, anchor, alias_to)
-        self.anchors.clear()
+        if self.anchors:
+            self.plugin.register_anchors(self.current_page, self.anchors, alias_to)
+            self.anchors.clear()
 
 
 @lru_cache
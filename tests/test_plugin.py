@@ -19,6 +19,34 @@ def test_url_registration() -> None:
         plugin.get_item_url("baz")
 
 
+def test_anchors_registration() -> None:
+    """Check that several anchors can be registered at once, then obtained."""
+    plugin = AutorefsPlugin()
+    plugin.register_anchors("foo1.html", ["foo", "bar"])
+    plugin.register_anchors("foo2.html", ["baz", "qux"], anchor="heading")
+
+    assert plugin.get_item_url("foo") == "foo1.html#foo"
+    assert plugin.get_item_url("bar") == "foo1.html#bar"
+    assert plugin.get_item_url("baz") == "foo2.html#heading"
+    assert plugin.get_item_url("qux") == "foo2.html#heading"
+
+
+def test_registration_of_str_subclasses() -> None:
+    """Check that identifiers can be instances of `str` subclasses, such as `markupsafe.Markup`."""
+
+    class Markup(str):
+        __slots__ = ()
+
+    plugin = AutorefsPlugin()
+    plugin.register_anchor(identifier=Markup("foo"), page="foo1.html")
+    plugin.register_anchors("foo2.html", [Markup("bar")])
+    plugin.register_url(identifier=Markup("baz"), url="https://example.org/baz.html")
+
+    assert plugin.get_item_url("foo") == "foo1.html#foo"
+    assert plugin.get_item_url("bar") == "foo2.html#bar"
+    assert plugin.get_item_url("baz") == "https://example.org/baz.html"
+
+
 def test_url_registration_with_from_url() -> None:
     """Check that URLs can be registered, then obtained, relative to a page."""
     plugin = AutorefsPlugin()
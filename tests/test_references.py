@@ -2,14 +2,24 @@
 
 from __future__ import annotations
 
+import sys
+from functools import lru_cache
 from textwrap import dedent
-from typing import Mapping
+from typing import Any, Mapping
+from xml.etree.ElementTree import Element, SubElement
 
 import markdown
 import pytest
 
+from mkdocs_autorefs import references
 from mkdocs_autorefs.plugin import AutorefsPlugin
-from mkdocs_autorefs.references import AutorefsExtension, AutorefsHookInterface, fix_refs, relative_url
+from mkdocs_autorefs.references import (
+    AnchorScannerTreeProcessor,
+    AutorefsExtension,
+    AutorefsHookInterface,
+    fix_refs,
+    relative_url,
+)
 
 
 @pytest.mark.parametrize(
@@ -35,6 +45,7 @@ from mkdocs_autorefs.references import AutorefsExtension, AutorefsHookInterface,
         ("a/b.html", "#x", "../#x"),
         ("", "a/#x", "a/#x"),
         ("", "a/b.html#x", "a/b.html#x"),
+        ("", "/a#x", "a#x"),
     ],
 )
 def test_relative_url(current_url: str, to_url: str, href_url: str) -> None:
@@ -42,6 +53,16 @@ def test_relative_url(current_url: str, to_url: str, href_url: str) -> None:
     assert relative_url(current_url, to_url) == href_url
 
 
+# Without a plugin, the extension holds no state: share it between Markdown instances.
+_DEFAULT_EXTENSION = AutorefsExtension()
+
+
+@lru_cache(maxsize=32)
+def _get_markdown(extensions: tuple[tuple[str, tuple[tuple[str, Any], ...]], ...]) -> markdown.Markdown:
+    extension_configs = {name: dict(config) for name, config in extensions}
+    return markdown.Markdown(extensions=[_DEFAULT_EXTENSION, *extension_configs], extension_configs=extension_configs)
+
+
 def run_references_test(
     url_map: dict[str, str],
     source: str,
@@ -59,13 +80,12 @@ def run_references_test(
         unmapped: The expected unmapped list.
         from_url: The source page URL.
     """
-    md = markdown.Markdown(extensions=[AutorefsExtension(), *extensions], extension_configs=extensions)
+    md = _get_markdown(tuple((name, tuple(sorted(config.items()))) for name, config in extensions.items()))
+    md.reset()
     content = md.convert(source)
 
-    def url_mapper(identifier: str) -> str:
-        return relative_url(from_url, url_map[identifier])
-
-    actual_output, actual_unmapped = fix_refs(content, url_mapper)
+    resolved = {identifier: relative_url(from_url, url) for identifier, url in url_map.items()}
+    actual_output, actual_unmapped = fix_refs(content, resolved.__getitem__)
     assert actual_output == output
     assert actual_unmapped == (unmapped or [])
 
@@ -227,6 +247,57 @@ def test_legacy_custom_required_reference() -> None:
     assert unmapped == [("bar", None)]
 
 
+def test_legacy_and_new_references_together() -> None:
+    """Check that legacy and new references are fixed in the same HTML."""
+    url_map = {"ok": "ok.html#ok"}
+    source = "<span data-autorefs-identifier=ok>a</span> <autoref identifier=ok>b</autoref> <span data-autorefs-identifier=no>c</span>"
+    with pytest.warns(DeprecationWarning, match="`span` elements are deprecated"):
+        output, unmapped = fix_refs(source, url_map.__getitem__)
+    assert output == (
+        '<a class="autorefs autorefs-internal" href="ok.html#ok">a</a> '
+        '<a class="autorefs autorefs-internal" href="ok.html#ok">b</a> '
+        "[c][no]"
+    )
+    assert unmapped == [("no", None)]
+
+
+def test_deprecated_legacy_regex_matches_fixer() -> None:
+    """Check that the deprecated `AUTO_REF_RE` can still be used with the legacy fixer."""
+    url_map = {"ok": "ok.html#ok"}
+    source = '<span data-autorefs-identifier=ok data-x="1">a</span>'
+    with pytest.warns(DeprecationWarning, match="`span` elements are deprecated"):
+        output = references.AUTO_REF_RE.sub(references._legacy_fix_ref(url_map.__getitem__, []), source)
+    assert output == '<a class="autorefs autorefs-internal" href="ok.html#ok" data-x="1">a</a>'
+
+
+@pytest.mark.parametrize(
+    ("source", "expected"),
+    [
+        (
+            "<span data-autorefs-identifier=a><autoref identifier=b>B</autoref></span>",
+            (
+                '<a class="autorefs autorefs-internal" href="a.html#a">'
+                '<a class="autorefs autorefs-internal" href="b.html#b">B</a></a>'
+            ),
+        ),
+        (
+            "<autoref identifier=b><span data-autorefs-identifier=a>A</span></autoref>",
+            (
+                '<a class="autorefs autorefs-internal" href="b.html#b">'
+                '<a class="autorefs autorefs-internal" href="a.html#a">A</a></a>'
+            ),
+        ),
+    ],
+)
+def test_nested_legacy_and_new_references(source: str, expected: str) -> None:
+    """Check that legacy and new references nested in each other are all fixed."""
+    url_map = {"a": "a.html#a", "b": "b.html#b"}
+    with pytest.warns(DeprecationWarning, match="`span` elements are deprecated"):
+        output, unmapped = fix_refs(source, url_map.__getitem__)
+    assert output == expected
+    assert unmapped == []
+
+
 def test_custom_required_reference() -> None:
     """Check that external HTML-based references are expanded or reported missing."""
     url_map = {"ok": "ok.html#ok"}
@@ -280,6 +351,29 @@ def test_custom_optional_hover_reference() -> None:
     assert unmapped == []
 
 
+def test_custom_optional_hover_reference_escaped_title() -> None:
+    """Check that identifiers are escaped exactly once in title attributes."""
+    url_map = {'o"k': "ok.html#ok"}
+    source = (
+        '<autoref optional hover identifier="b&amp;r">foo</autoref> '
+        '<autoref optional hover identifier="o&quot;k">ok</autoref>'
+    )
+    output, unmapped = fix_refs(source, url_map.__getitem__)
+    assert output == (
+        '<span title="b&amp;r">foo</span> '
+        '<a class="autorefs autorefs-internal" title="o&quot;k" href="ok.html#ok">ok</a>'
+    )
+    assert unmapped == []
+
+
+def test_unmapped_reference_escaped_identifier() -> None:
+    """Check that identifiers are escaped exactly once in unmapped references."""
+    source = '<autoref identifier="a&lt;b">t</autoref> <autoref identifier="a&lt;b">a&lt;b</autoref>'
+    output, unmapped = fix_refs(source, {}.__getitem__)
+    assert output == "[t][a&lt;b] [a&lt;b][]"
+    assert unmapped == [("a<b", None), ("a<b", None)]
+
+
 def test_legacy_external_references() -> None:
     """Check that external references are marked as such."""
     url_map = {"example": "https://example.com"}
@@ -299,50 +393,78 @@ def test_external_references() -> None:
     assert unmapped == []
 
 
-def test_register_markdown_anchors() -> None:
-    """Check that Markdown anchors are registered when enabled."""
+def test_external_references_with_leading_whitespace() -> None:
+    """Check that external references are detected like `urlsplit` does, ignoring leading whitespace."""
+    url_map = {"example": " https://example.com", "mail": "\tmailto:a@example.com"}
+    source = '<autoref identifier="example">example</autoref> <autoref identifier="mail">mail</autoref>'
+    output, unmapped = fix_refs(source, url_map.__getitem__)
+    assert output == (
+        '<a class="autorefs autorefs-external" href=" https://example.com">example</a> '
+        '<a class="autorefs autorefs-external" href="\tmailto:a@example.com">mail</a>'
+    )
+    assert unmapped == []
+
+
+# Building a Markdown instance is costly: share one per set of extensions between tests.
+@lru_cache(maxsize=None)
+def _get_anchors_pipeline(extensions: tuple[str, ...]) -> tuple[AutorefsPlugin, markdown.Markdown]:
     plugin = AutorefsPlugin()
-    md = markdown.Markdown(extensions=["attr_list", "toc", AutorefsExtension(plugin)])
+    md = markdown.Markdown(extensions=[*extensions, AutorefsExtension(plugin)])
+    return plugin, md
+
+
+def _anchors_pipeline(*extensions: str) -> tuple[AutorefsPlugin, markdown.Markdown]:
+    """Return a plugin and a Markdown instance scanning anchors, both reset."""
+    plugin, md = _get_anchors_pipeline(extensions)
+    plugin._url_map.clear()
     plugin.current_page = "page"
-    md.convert(
-        dedent(
-            """
-            [](){#foo}
-            ## Heading foo
-
-            Paragraph 1.
-
-            [](){#bar}
-            Paragraph 2.
-
-            [](){#alias1}
-            [](){#alias2}
-            ## Heading bar
-
-            [](){#alias3}
-            Text.
-            [](){#alias4}
-            ## Heading baz
-
-            [](){#alias5}
-            [](){#alias6}
-            Decoy.
-            ## Heading more1
-
-            [](){#alias7}
-            [decoy](){#alias8}
-            [](){#alias9}
-            ## Heading more2 {#heading-custom2}
-
-            [](){#aliasSame}
-            ## Same heading 1
-            [](){#aliasSame}
-            ## Same heading 2
-
-            [](){#alias10}
-            """,
-        ),
-    )
+    md.reset()
+    return plugin, md
+
+
+_ANCHORS_SOURCE = dedent(
+    """
+    [](){#foo}
+    ## Heading foo
+
+    Paragraph 1.
+
+    [](){#bar}
+    Paragraph 2.
+
+    [](){#alias1}
+    [](){#alias2}
+    ## Heading bar
+
+    [](){#alias3}
+    Text.
+    [](){#alias4}
+    ## Heading baz
+
+    [](){#alias5}
+    [](){#alias6}
+    Decoy.
+    ## Heading more1
+
+    [](){#alias7}
+    [decoy](){#alias8}
+    [](){#alias9}
+    ## Heading more2 {#heading-custom2}
+
+    [](){#aliasSame}
+    ## Same heading 1
+    [](){#aliasSame}
+    ## Same heading 2
+
+    [](){#alias10}
+    """,
+)
+
+
+def test_register_markdown_anchors() -> None:
+    """Check that Markdown anchors are registered when enabled."""
+    plugin, md = _anchors_pipeline("attr_list", "toc")
+    md.convert(_ANCHORS_SOURCE)
     assert plugin._url_map == {
         "foo": ["page#heading-foo"],
         "bar": ["page#bar"],
@@ -360,26 +482,25 @@ def test_register_markdown_anchors() -> None:
     }
 
 
+_ANCHORS_ADMONITION_SOURCE = dedent(
+    """
+    [](){#alias1}
+    !!! note
+        ## Heading foo
+
+        [](){#alias2}
+        ## Heading bar
+
+        [](){#alias3}
+    ## Heading baz
+    """,
+)
+
+
 def test_register_markdown_anchors_with_admonition() -> None:
     """Check that Markdown anchors are registered inside a nested admonition element."""
-    plugin = AutorefsPlugin()
-    md = markdown.Markdown(extensions=["attr_list", "toc", "admonition", AutorefsExtension(plugin)])
-    plugin.current_page = "page"
-    md.convert(
-        dedent(
-            """
-            [](){#alias1}
-            !!! note
-                ## Heading foo
-
-                [](){#alias2}
-                ## Heading bar
-
-                [](){#alias3}
-            ## Heading baz
-            """,
-        ),
-    )
+    plugin, md = _anchors_pipeline("attr_list", "toc", "admonition")
+    md.convert(_ANCHORS_ADMONITION_SOURCE)
     assert plugin._url_map == {
         "alias1": ["page#alias1"],
         "alias2": ["page#heading-bar"],
@@ -402,3 +523,47 @@ def test_keep_data_attributes() -> None:
     source = '<autoref optional identifier="example" class="hi ho" data-foo data-bar="0">e</autoref>'
     output, _ = fix_refs(source, url_map.__getitem__)
     assert output == '<a class="autorefs autorefs-external hi ho" href="https://e.com" data-foo data-bar="0">e</a>'
+
+
+def test_duplicate_data_attributes() -> None:
+    """Keep only the last value of duplicated HTML data attributes."""
+    url_map = {"example": "https://e.com"}
+    source = '<autoref identifier="example" data-x data-x="2">e</autoref>'
+    output, _ = fix_refs(source, url_map.__getitem__)
+    assert output == '<a class="autorefs autorefs-external" href="https://e.com" data-x="2">e</a>'
+
+
+def test_unmapped_reference_context() -> None:
+    """Check that the context of unmapped references is reported."""
+    source = '<autoref identifier="bar" domain="py" role="class" origin="foo" filepath="foo.py" lineno="1">b</autoref>'
+    output, unmapped = fix_refs(source, {}.__getitem__)
+    assert output == "[b][bar]"
+    assert unmapped == [("bar", AutorefsHookInterface.Context("py", "class", "foo", "foo.py", 1))]
+
+
+def test_url_mapper_called_once_per_identifier() -> None:
+    """Check that the URL mapper is called only once per identifier."""
+    calls = []
+
+    def url_mapper(identifier: str) -> str:
+        calls.append(identifier)
+        return {"ok": "ok.html#ok"}[identifier]
+
+    source = "<autoref identifier=ok>a</autoref> <autoref identifier=no>b</autoref> " * 2
+    output, unmapped = fix_refs(source, url_mapper)
+    assert output == '<a class="autorefs autorefs-internal" href="ok.html#ok">a</a> [b][no] ' * 2
+    assert unmapped == [("no", None), ("no", None)]
+    assert calls == ["ok", "no"]
+
+
+def test_register_deeply_nested_markdown_anchors() -> None:
+    """Check that anchors are registered in elements nested deeper than the recursion limit."""
+    plugin = AutorefsPlugin()
+    plugin.current_page = "page"
+    root = parent = Element("div")
+    for _ in range(sys.getrecursionlimit() + 100):
+        parent = SubElement(parent, "div")
+    SubElement(parent, "a", {"id": "alias"})
+    SubElement(parent, "h2", {"id": "heading"})
+    AnchorScannerTreeProcessor(plugin).run(root)
+    assert plugin._url_map == {"alias": ["page#heading"]}